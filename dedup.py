@@ -0,0 +1,137 @@
+import re
+import sys
+import time
+import zlib
+import random
+from array import array
+from typing import Dict, Hashable, List, Optional, Tuple
+
+# ===================== Поиск почти-дубликатов заказов =====================
+# MinHash по словесным шинглам + LSH по полосам сигнатуры.
+# Запрос смотрит только в корзины своих полос — время не зависит от числа
+# заказов в индексе (кроме размера корзин с похожими текстами).
+# Бенчмарк: python dedup.py [кол-во_заказов]
+# ========================================================================
+
+_P = (1 << 61) - 1  # простое Мерсенна для универсального хеширования
+_WORD = re.compile(r"\w+")
+
+def shingles(text: str) -> set:
+    words = _WORD.findall((text or "").lower().replace("ё", "е"))
+    if len(words) < 2:
+        return set(words)
+    return {f"{a} {b}" for a, b in zip(words, words[1:])}
+
+class MinHashLSH:
+    def __init__(self, num_perm: int = 36, bands: int = 12, threshold: float = 0.6, seed: int = 1):
+        if num_perm % bands:
+            raise ValueError("num_perm must be divisible by bands")
+        rnd = random.Random(seed)
+        self.perms = [(rnd.randrange(1, _P), rnd.randrange(0, _P)) for _ in range(num_perm)]
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.threshold = threshold
+        self.signatures: Dict[Hashable, array] = {}
+        self.buckets: Dict[int, List[Hashable]] = {}  # hash(полоса, значения) -> ключи
+
+    def __len__(self) -> int:
+        return len(self.signatures)
+
+    def signature(self, text: str) -> Optional[array]:
+        xs = [zlib.crc32(s.encode("utf-8")) for s in shingles(text)]
+        if not xs:
+            return None
+        return array("Q", (min((a * x + b) % _P for x in xs) for a, b in self.perms))
+
+    def _band_keys(self, sig: array):
+        r = self.rows
+        for i in range(self.bands):
+            yield hash((i, *sig[i * r:(i + 1) * r]))
+
+    def add(self, key: Hashable, text: str):
+        sig = self.signature(text)
+        if sig is None:
+            return
+        self.remove(key)
+        self.signatures[key] = sig
+        for bk in self._band_keys(sig):
+            self.buckets.setdefault(bk, []).append(key)
+
+    def remove(self, key: Hashable):
+        sig = self.signatures.pop(key, None)
+        if sig is None:
+            return
+        for bk in self._band_keys(sig):
+            keys = self.buckets.get(bk)
+            if keys is None:
+                continue
+            try:
+                keys.remove(key)
+            except ValueError:
+                pass
+            if not keys:
+                del self.buckets[bk]
+
+    def query(self, text: str) -> List[Tuple[Hashable, float]]:
+        """Ключи с оценкой сходства по Жаккару >= threshold, по убыванию сходства."""
+        sig = self.signature(text)
+        if sig is None:
+            return []
+        candidates = set()
+        for bk in self._band_keys(sig):
+            candidates.update(self.buckets.get(bk, ()))
+        n = len(sig)
+        found = []
+        for key in candidates:
+            other = self.signatures[key]
+            sim = sum(1 for x, y in zip(sig, other) if x == y) / n
+            if sim >= self.threshold:
+                found.append((key, sim))
+        found.sort(key=lambda kv: kv[1], reverse=True)
+        return found
+
+# --------------------- Benchmark ---------------------
+
+_VOCAB = (
+    "снять поклеить обои покрасить стены потолок плитка ванная кухня комната ламинат укладка "
+    "демонтаж штукатурка шпаклевка розетки проводка замена сантехника смеситель унитаз дверь "
+    "окно откосы стяжка пол линолеум гипсокартон перегородка утеплить балкон лоджия крыша "
+    "забор фундамент кладка кирпич блок сайдинг фасад покраска срочно недорого аккуратно "
+    "материал мой ваш квартира дом дача гараж этаж лифт подъезд метров кв м2 два три"
+).split()
+
+def _random_desc(rnd: random.Random) -> str:
+    return " ".join(rnd.choice(_VOCAB) for _ in range(rnd.randint(8, 16)))
+
+def _mutate(rnd: random.Random, text: str) -> str:
+    words = text.split()
+    words[rnd.randrange(len(words))] = rnd.choice(_VOCAB)
+    return " ".join(words)
+
+def benchmark(n: int = 100_000, queries: int = 1000):
+    rnd = random.Random(42)
+    idx = MinHashLSH()
+    docs = [_random_desc(rnd) for _ in range(n)]
+    t0 = time.perf_counter()
+    for i, d in enumerate(docs):
+        idx.add(i, d)
+    build = time.perf_counter() - t0
+
+    lat, hits = [], 0
+    for q in range(queries):
+        src = rnd.randrange(n)
+        # половина запросов — почти-дубликаты (одно слово заменено), половина — новые тексты
+        text = _mutate(rnd, docs[src]) if q % 2 == 0 else _random_desc(rnd)
+        t = time.perf_counter()
+        res = idx.query(text)
+        lat.append(time.perf_counter() - t)
+        if q % 2 == 0 and any(k == src for k, _ in res):
+            hits += 1
+    lat.sort()
+    ms = lambda v: f"{v * 1000:.3f} ms"
+    print(f"indexed: {n} orders in {build:.1f}s ({build / n * 1e6:.0f} us/order), buckets: {len(idx.buckets)}")
+    print(f"query: p50 {ms(lat[len(lat) // 2])}, p99 {ms(lat[int(len(lat) * 0.99)])}, max {ms(lat[-1])}")
+    print(f"near-duplicate recall: {hits / (queries // 2):.1%}")
+
+if __name__ == "__main__":
+    benchmark(int(sys.argv[1]) if len(sys.argv) > 1 else 100_000)
@@ -1,7 +1,17 @@
 import os
+import io
+import re
+import csv
+import json
+import time
+import uuid
+import zlib
+import hashlib
 import asyncio
 from dataclasses import dataclass, field
-from typing import Dict, Optional, Tuple, List
+from typing import Dict, Optional, Tuple, List, Iterator, Callable, AsyncGenerator
+from collections import deque
+from itertools import islice
 from datetime import datetime, timedelta
 from dotenv import load_dotenv
 
@@ -9,14 +19,18 @@ from aiogram import Bot, Dispatcher, F
 from aiogram.client.default import DefaultBotProperties
 from aiogram.enums import ParseMode
 from aiogram.types import (
-    Message, CallbackQuery,
-    InlineKeyboardMarkup, InlineKeyboardButton,
+    Message, CallbackQuery, ChatMemberUpdated,
+    InlineKeyboardMarkup, InlineKeyboardButton, InputFile,
 )
+from aiogram.exceptions import TelegramForbiddenError, TelegramRetryAfter
+from aiogram.dispatcher.event.bases import SkipHandler
 from aiogram.filters import CommandStart, Command
 from aiogram.fsm.state import StatesGroup, State
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.storage.memory import MemoryStorage
 
+from dedup import MinHashLSH
+
 # ===================== SIMPLE, INLINE-FIRST MVP =====================
 # • Инлайн-кнопки, простой выбор даты/времени.
 # • «Связаться» — текст с номером. Можно просто написать свой номер.
@@ -37,6 +51,18 @@ SUPPORT_NAME = os.getenv("SUPPORT_NAME", "Диспетчер")
 ADMIN_IDS = {int(x) for x in os.getenv("ADMIN_IDS", "").replace(" ", "").split(",") if x.isdigit()}
 PHONE_SHARE_RATE_LIMIT = int(os.getenv("PHONE_SHARE_RATE_LIMIT", "300"))  # сек
 COMMISSION_PCT = float(os.getenv("COMMISSION_PCT", "10")) / 100.0
+BROADCAST_DIR = os.getenv("BROADCAST_DIR", "broadcast")
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", "20"))  # сообщений/сек (лимит Telegram ~30/сек, оставляем запас)
+if BROADCAST_RATE <= 0:
+    raise RuntimeError("BROADCAST_RATE must be > 0")
+BROADCAST_SAVE_EVERY = 10  # как часто сохраняем курсор рассылки
+RECORD_UPDATES = os.getenv("RECORD_UPDATES")  # путь к JSONL для записи входящих апдейтов (replay.py)
+RECORD_ANONYMIZE = os.getenv("RECORD_ANONYMIZE", "0") == "1"
+RECORD_SALT = os.getenv("RECORD_SALT", "")
+TRANSCRIPT_DIR = os.getenv("TRANSCRIPT_DIR", "transcripts")
+TRANSCRIPT_RING = int(os.getenv("TRANSCRIPT_RING", "50"))  # сообщений в памяти на чат
+TRANSCRIPT_MAX_TEXT = 500  # символов текста на сообщение
+TRANSCRIPT_MAX_TOKENS = 300  # разных слов в поисковом индексе на чат
 
 # --------------------- Data Models ---------------------
 
@@ -50,6 +76,9 @@ class User:
     username: Optional[str] = None
     full_name: str = ""
     availability_text: Optional[str] = None
+    availability: List[Tuple[datetime, datetime]] = field(default_factory=list)  # [начало, конец), по часам
+    last_seen: datetime = field(default_factory=datetime.utcnow)
+    blocked: bool = False  # пользователь заблокировал бота
 
 @dataclass
 class Order:
@@ -63,6 +92,9 @@ class Order:
     status: str = "open"  # open|matched|closed
     bids: Dict[int, float] = field(default_factory=dict)  # executor_id -> price (net)
     chosen_executor_id: Optional[int] = None
+    published: bool = False
+    notified: set = field(default_factory=set)  # исполнители, получившие уведомление о заказе
+    created_ts: datetime = field(default_factory=datetime.utcnow)
 
 @dataclass
 class Match:
@@ -72,6 +104,14 @@ class Match:
     active: bool = True
     reveal_requested: Dict[int, bool] = field(default_factory=dict)
     reveal_approved_by_dispatcher: bool = False
+    # Переписка: последние сообщения (ts, from_user_id, тип, текст) в памяти,
+    # более старые сегменты — в TRANSCRIPT_DIR/<order_id>_<key>.jsonl
+    # (id заказов после рестарта начинаются заново, key делает файл уникальным)
+    transcript: deque = field(default_factory=deque)
+    spilled: int = 0
+    key: str = field(default_factory=lambda: uuid.uuid4().hex[:12])
+    tokens: set = field(default_factory=set)  # слова в TRANSCRIPT_INDEX, не больше TRANSCRIPT_MAX_TOKENS
+    tokens_overflow: bool = False  # в чате больше слов, чем попало в индекс — ищем по нему перебором
 
 @dataclass
 class CallLog:
@@ -83,6 +123,31 @@ class CallLog:
     source: str  # "button" | "text"
     status: str = "new"  # new|done
 
+@dataclass
+class Campaign:
+    id: int
+    created_by: int
+    segment: str
+    from_chat_id: int
+    message_id: int
+    targets: List[int] = field(default_factory=list)
+    cursor: int = 0  # индекс следующего получателя в targets
+    status: str = "running"  # running|paused|done|cancelled
+    sent: int = 0
+    blocked: int = 0
+    failed: int = 0
+    created_ts: datetime = field(default_factory=datetime.utcnow)
+
+@dataclass
+class Stats:
+    # Агрегаты обновляются при каждой мутации, /stats читает их за O(1)
+    orders_total: int = 0
+    orders_matched: int = 0
+    bids_total: int = 0
+    gross_total: float = 0.0  # сумма для клиентов (цена + комиссия)
+    commission_total: float = 0.0
+    orders_per_day: Dict[str, int] = field(default_factory=dict)  # "YYYY-MM-DD" -> кол-во
+
 USERS: Dict[int, User] = {}
 ORDERS: Dict[int, Order] = {}
 MATCHES: Dict[int, Match] = {}
@@ -93,6 +158,24 @@ _call_log_seq = 1
 
 LAST_PHONE_SHARE: Dict[int, datetime] = {}
 
+# Поиск по активным перепискам: слово -> заказы, в чьей переписке оно встречалось.
+# Слова закрытых чатов уходят из памяти в индекс на диске TRANSCRIPT_DIR/index/.
+TRANSCRIPT_INDEX: Dict[str, set] = {}
+
+# Индекс доступности: начало часа -> исполнители, свободные в этот час.
+# Поиск свободных на when_dt — один lookup, O(1 + k).
+AVAIL_INDEX: Dict[datetime, set] = {}
+_avail_pruned_at: Optional[datetime] = None
+
+STATS = Stats()
+
+# Открытые заказы в MinHash/LSH-индексе для поиска почти-дубликатов
+ORDER_DEDUP = MinHashLSH()
+
+CAMPAIGNS: Dict[int, Campaign] = {}
+CAMPAIGN_TASKS: Dict[int, asyncio.Task] = {}
+_campaign_seq = 1
+
 _order_seq = 1
 def next_order_id() -> int:
     global _order_seq
@@ -106,6 +189,12 @@ def next_call_log_id() -> int:
     _call_log_seq += 1
     return i
 
+def next_campaign_id() -> int:
+    global _campaign_seq
+    i = _campaign_seq
+    _campaign_seq += 1
+    return i
+
 # --------------------- Helpers ---------------------
 
 def is_dispatcher(uid: int) -> bool:
@@ -158,6 +247,162 @@ def add_call_log(user: User, phone: str, source: str) -> CallLog:
     CALL_LOGS[log.id] = log
     return log
 
+def hour_slot(dt: datetime) -> datetime:
+    return dt.replace(minute=0, second=0, microsecond=0)
+
+def _hour_slots(start: datetime, end: datetime):
+    t = start
+    while t < end:
+        yield t
+        t += timedelta(hours=1)
+
+def set_availability(u: User, intervals: List[Tuple[datetime, datetime]]):
+    # Снимаем старые слоты из индекса, склеиваем пересечения и прошедшее отбрасываем
+    now = datetime.now()
+    now_slot = hour_slot(now)
+    for start, end in u.availability:
+        for h in _hour_slots(max(start, now_slot), end):
+            slot = AVAIL_INDEX.get(h)
+            if slot is not None:
+                slot.discard(u.user_id)
+                if not slot:
+                    del AVAIL_INDEX[h]
+    merged: List[Tuple[datetime, datetime]] = []
+    for start, end in sorted(i for i in intervals if i[1] > now):
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    u.availability = merged
+    for start, end in merged:
+        # Уже идущий интервал индексируем с текущего часа, прошедшие часы не нужны
+        for h in _hour_slots(max(start, now_slot), end):
+            AVAIL_INDEX.setdefault(h, set()).add(u.user_id)
+    u.availability_text = "; ".join(
+        f"{start.strftime('%d.%m %H:%M')}–{end.strftime('%H:%M')}" for start, end in merged
+    ) or None
+
+def prune_availability():
+    # Прошедшие часы выкидываем из индекса не чаще раза в час
+    global _avail_pruned_at
+    now_slot = hour_slot(datetime.now())
+    if _avail_pruned_at == now_slot:
+        return
+    _avail_pruned_at = now_slot
+    for h in [h for h in AVAIL_INDEX if h < now_slot]:
+        del AVAIL_INDEX[h]
+
+def free_executors(when: Optional[datetime]) -> frozenset:
+    prune_availability()
+    if not when:
+        return frozenset()
+    return frozenset(AVAIL_INDEX.get(hour_slot(when), ()))
+
+def is_free(uid: int, when: Optional[datetime]) -> bool:
+    prune_availability()
+    return bool(when) and uid in AVAIL_INDEX.get(hour_slot(when), ())
+
+def stats_order_created(o: Order):
+    STATS.orders_total += 1
+    day = o.created_ts.strftime("%Y-%m-%d")
+    STATS.orders_per_day[day] = STATS.orders_per_day.get(day, 0) + 1
+
+def stats_order_matched(price: float):
+    commission = round(price * COMMISSION_PCT, 2)
+    STATS.orders_matched += 1
+    STATS.gross_total += round(price + commission, 2)
+    STATS.commission_total += commission
+
+@dp.update.outer_middleware()
+async def touch_last_seen(handler, event, data):
+    # Отмечаем активность для сегментов рассылки («неактивны N дней»)
+    fu = data.get("event_from_user")
+    if fu:
+        u = USERS.get(fu.id)
+        if u:
+            u.last_seen = datetime.utcnow()
+    return await handler(event, data)
+
+@dp.my_chat_member()
+async def on_my_chat_member(ev: ChatMemberUpdated):
+    u = USERS.get(ev.from_user.id)
+    if u:
+        u.blocked = ev.new_chat_member.status == "kicked"
+
+# --------------------- Record updates (для replay.py) ---------------------
+
+_record_file = None
+_PEER_KEYS = {"from", "chat", "user", "sender_chat", "sender_user", "forward_from", "forward_from_chat", "via_bot"}
+# Поля callback_data, в которых лежат id пользователей: cchoose:<order_id>:<executor_id>
+_CALLBACK_USER_FIELDS = {"cchoose": (2,)}
+# id пользователей в текстах бота («Выбрать <id>») и ссылках tg://user?id=<id>
+_TEXT_USER_ID_RE = re.compile(r"((?:Исполнитель|Выбрать) |tg://user\?id=)(\d+)")
+_PHONE_RE = re.compile(r"\+?\d[\d\s\-()]{6,}\d")  # кандидаты: цифры с пробелами/дефисами/скобками
+_BY_CODES = {"17", "25", "29", "33", "44"}
+
+def _anon_id(i: int) -> int:
+    # Стабильная замена id: одинаковый id -> одинаковый псевдоним во всём файле и между рестартами
+    if i < 0:
+        return i  # группы/каналы не трогаем
+    h = hashlib.blake2b(f"{RECORD_SALT}:{i}".encode(), digest_size=5).digest()
+    return 10**9 + int.from_bytes(h, "big") % 10**9
+
+def _is_phone(s: str) -> bool:
+    # Только номера по форме (+…, 375…, 80…, 0XX…, XX ХХХ-ХХ-ХХ), а не даты и любые длинные числа
+    d = re.sub(r"\D", "", s)
+    if s.startswith("+"):
+        return 9 <= len(d) <= 15
+    return ((len(d) == 12 and d.startswith("375")) or (len(d) == 11 and d.startswith("80"))
+            or (len(d) == 10 and d[0] == "0" and d[1:3] in _BY_CODES) or (len(d) == 9 and d[:2] in _BY_CODES))
+
+def _anon_text(s: str) -> str:
+    s = _PHONE_RE.sub(lambda mo: re.sub(r"\d", "0", mo.group()) if _is_phone(mo.group()) else mo.group(), s)
+    return _TEXT_USER_ID_RE.sub(lambda mo: mo.group(1) + str(_anon_id(int(mo.group(2)))), s)
+
+def _anon_callback(data: str) -> str:
+    parts = data.split(":")
+    for i in _CALLBACK_USER_FIELDS.get(parts[0], ()):
+        if i < len(parts) and parts[i].isdigit():
+            parts[i] = str(_anon_id(int(parts[i])))
+    return ":".join(parts)
+
+def anonymize_update(d, key: Optional[str] = None):
+    if isinstance(d, list):
+        return [anonymize_update(x, key) for x in d]
+    if not isinstance(d, dict):
+        return d
+    out = {}
+    for k, v in d.items():
+        if k == "id" and key in _PEER_KEYS and isinstance(v, int):
+            out[k] = _anon_id(v)
+        elif k in ("first_name", "title"):
+            out[k] = "User"
+        elif k in ("last_name", "username"):
+            continue
+        elif k in ("user_id", "from_user_id") and isinstance(v, int):
+            out[k] = _anon_id(v)
+        elif k in ("data", "callback_data") and isinstance(v, str):
+            out[k] = _anon_callback(v)
+        elif k in ("text", "caption", "phone_number", "url") and isinstance(v, str):
+            out[k] = _anon_text(v)
+        else:
+            out[k] = anonymize_update(v, k)
+    return out
+
+@dp.update.outer_middleware()
+async def record_update(handler, event, data):
+    global _record_file
+    if RECORD_UPDATES:
+        raw = event.model_dump(mode="json", by_alias=True, exclude_none=True)
+        if RECORD_ANONYMIZE:
+            raw = anonymize_update(raw)
+        if _record_file is None:
+            os.makedirs(os.path.dirname(RECORD_UPDATES) or ".", exist_ok=True)
+            _record_file = open(RECORD_UPDATES, "a", encoding="utf-8")
+        _record_file.write(json.dumps({"ts": time.time(), "update": raw}, ensure_ascii=False) + "\n")
+        _record_file.flush()
+    return await handler(event, data)
+
 # --------------------- States ---------------------
 
 class CreateOrder(StatesGroup):
@@ -176,6 +421,9 @@ class SharePhone(StatesGroup):
 class Availability(StatesGroup):
     waiting_text = State()
 
+class Broadcast(StatesGroup):
+    waiting_message = State()
+
 # --------------------- Start & Role ---------------------
 
 @dp.message(CommandStart())
@@ -229,6 +477,8 @@ async def show_menu(uid: int):
             [InlineKeyboardButton(text="👁 Открытые заказы", callback_data="d:open")],
             [InlineKeyboardButton(text="🔗 Активные чаты", callback_data="d:chats")],
             [InlineKeyboardButton(text="📞 Логи звонков", callback_data="d:logs")],
+            [InlineKeyboardButton(text="📣 Рассылки", callback_data="d:bc")],
+            [InlineKeyboardButton(text="📊 Статистика", callback_data="d:stats")],
             [InlineKeyboardButton(text="ℹ️ Помощь", callback_data="d:help")],
         ])
         await bot.send_message(uid, "Панель диспетчера:", reply_markup=kb)
@@ -355,21 +605,95 @@ async def c_address(m: Message, state: FSMContext):
     else:
         address_text = m.text.strip()
 
+    dups = [(ORDERS[k], sim) for k, sim in ORDER_DEDUP.query(desc)
+            if k in ORDERS and ORDERS[k].status == "open"]
+    mine = [o for o, _ in dups if o.customer_id == m.from_user.id]
+    same_place = [o for o in mine if (o.address_text, o.latlon) == (address_text, latlon)
+                  and o.when_dt and o.when_dt.date() == when.date()]
+    own = (same_place or mine or [None])[0]
+    if own:
+        if not same_place:
+            # Адрес или день другие — возможно, та же работа на другом объекте, спросим
+            await state.update_data(address_text=address_text, latlon=latlon, dup_of=own.id)
+            rows = [
+                [InlineKeyboardButton(text=f"♻️ Обновить заказ #{own.id}", callback_data=f"cdup:merge:{own.id}")],
+                [InlineKeyboardButton(text="➕ Это другой заказ", callback_data="cdup:new")],
+                [InlineKeyboardButton(text="Отмена", callback_data="home")],
+            ]
+            await m.answer(
+                f"Похоже на ваш заказ #{own.id} ({own.when_dt.strftime('%d.%m %H:%M') if own.when_dt else '—'}, "
+                f"{own.address_text or 'геометка'}). Обновить его или создать новый?",
+                reply_markup=InlineKeyboardMarkup(inline_keyboard=rows)
+            )
+            return
+        oid, head = await merge_order(own, when, address_text, latlon)
+    else:
+        oid, head = await create_order(m.from_user.id, desc, when, address_text, latlon, dups)
+    await ask_docs(m, state, oid, head, when, address_text)
+
+async def create_order(customer_id: int, desc: str, when: datetime, address_text: Optional[str],
+                       latlon: Optional[Tuple[float, float]], dups: list) -> Tuple[int, str]:
     oid = next_order_id()
     ORDERS[oid] = Order(
-        id=oid, customer_id=m.from_user.id, description=desc, when_dt=when,
+        id=oid, customer_id=customer_id, description=desc, when_dt=when,
         address_text=address_text, latlon=latlon, attachments_count=0, status="open"
     )
+    ORDER_DEDUP.add(oid, desc)
+    stats_order_created(ORDERS[oid])
+    other = next((o for o, _ in dups if o.customer_id != customer_id), None)
+    if other:
+        sim = next(sim for o, sim in dups if o is other)
+        await notify_dispatchers(
+            f"⚠️ Заказ #{oid} похож на #{other.id} другого заказчика (сходство {sim:.0%}). Проверьте: «Открытые заказы»."
+        )
+    return oid, f"✅ Заказ #{oid} создан."
+
+async def merge_order(own: Order, when: datetime, address_text: Optional[str],
+                      latlon: Optional[Tuple[float, float]]) -> Tuple[int, str]:
+    # Повтор своего же заказа — обновляем существующий вместо нового
+    changed = (own.when_dt, own.address_text, own.latlon) != (when, address_text, latlon)
+    time_changed = own.when_dt != when
+    own.when_dt, own.address_text, own.latlon = when, address_text, latlon
+    if changed:
+        # Кто предлагал цену или получил уведомление — видел старые дату/адрес
+        informed = set(own.bids) | own.notified
+        for eid in informed:
+            try:
+                await bot.send_message(eid, "✏️ Заказчик изменил дату или адрес:\n\n" + order_card(own), reply_markup=bid_kb(own))
+            except Exception:
+                pass
+        if time_changed and own.published:
+            await notify_free_executors(own, skip=informed)
+        return own.id, f"♻️ Похожий заказ #{own.id} уже есть — обновили дату и адрес."
+    return own.id, f"♻️ Такой заказ #{own.id} уже есть."
 
+async def ask_docs(m: Message, state: FSMContext, oid: int, head: str, when: datetime, address_text: Optional[str]):
     await state.set_state(CreateOrder.collecting_docs)
     rows = [[InlineKeyboardButton(text="📎 Готово (без документов)", callback_data=f"cfinish:{oid}")]]
     addr_show = address_text or "геометка"
     await m.answer(
-        f"✅ Заказ #{oid} создан.\nДата и время: *{when.strftime('%d.%m %H:%M')}*\nАдрес: *{addr_show}*\n\n"
+        f"{head}\nДата и время: *{when.strftime('%d.%m %H:%M')}*\nАдрес: *{addr_show}*\n\n"
         f"Если хотите — пришлите фото/файлы. Потом нажмите кнопку ниже.",
         reply_markup=InlineKeyboardMarkup(inline_keyboard=rows)
     )
 
+@dp.callback_query(F.data.startswith("cdup:"))
+async def c_dup_choice(c: CallbackQuery, state: FSMContext):
+    data = await state.get_data()
+    if await state.get_state() != CreateOrder.waiting_address.state or "dup_of" not in data:
+        await c.answer("Недоступно", show_alert=True)
+        return
+    when = datetime.strptime(f"{data['day']} {data['time']}", "%Y-%m-%d %H:%M")
+    address_text = data.get("address_text")
+    latlon = tuple(data["latlon"]) if data.get("latlon") else None
+    own = ORDERS.get(data["dup_of"])
+    if c.data.startswith("cdup:merge:") and own and own.status == "open" and own.customer_id == c.from_user.id:
+        oid, head = await merge_order(own, when, address_text, latlon)
+    else:
+        oid, head = await create_order(c.from_user.id, data["description"], when, address_text, latlon, [])
+    await c.answer()
+    await ask_docs(c.message, state, oid, head, when, address_text)
+
 @dp.message(CreateOrder.collecting_docs, F.content_type.in_({"photo", "document"}))
 async def c_docs(m: Message, state: FSMContext):
     for o in ORDERS.values():
@@ -388,30 +712,133 @@ async def c_finish(c: CallbackQuery):
     await c.answer()
     await c.message.answer("Заказ опубликован. Исполнители рядом увидят и пришлют цены.")
     await show_menu(c.from_user.id)
+    if not o.published:
+        o.published = True
+        await notify_free_executors(o)
+
+async def notify_free_executors(o: Order, skip: frozenset = frozenset()):
+    # Уведомляем только тех, кто отметил себя свободным на время заказа
+    for eid in free_executors(o.when_dt):
+        u = USERS.get(eid)
+        if not u or u.role != "executor" or u.blocked or eid == o.customer_id or eid in skip:
+            continue
+        try:
+            await bot.send_message(eid, "🔔 Новый заказ в ваше свободное время:\n\n" + order_card(o), reply_markup=bid_kb(o))
+            o.notified.add(eid)
+        except Exception:
+            pass
 
 # --------------------- Executor: Feed & Bids ---------------------
 
-@dp.callback_query(F.data == "e:feed")
+def order_card(o: Order) -> str:
+    addr = o.address_text or "геометка"
+    return (
+        f"📌 Заказ #{o.id}\n"
+        f"Дата: {o.when_dt.strftime('%d.%m %H:%M') if o.when_dt else '—'}\n"
+        f"Адрес: {addr}\n\n"
+        f"{o.description}\n\n📎 Вложений: {o.attachments_count}"
+    )
+
+def bid_kb(o: Order) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="💰 Предложить цену", callback_data=f"ebid:{o.id}")]
+    ])
+
+@dp.callback_query(F.data.in_({"e:feed", "e:feedfree"}))
 async def e_feed(c: CallbackQuery):
     opens = [o for o in ORDERS.values() if o.status == "open"]
+    if c.data == "e:feedfree":
+        opens = [o for o in opens if is_free(c.from_user.id, o.when_dt)]
     if not opens:
         await c.message.answer("Пока нет открытых заказов. Зайдите позже.")
         await c.answer()
         return
     for o in sorted(opens, key=lambda x: (x.when_dt or datetime.max)):
-        addr = o.address_text or "геометка"
-        text = (
-            f"📌 Заказ #{o.id}\n"
-            f"Дата: {o.when_dt.strftime('%d.%m %H:%M') if o.when_dt else '—'}\n"
-            f"Адрес: {addr}\n\n"
-            f"{o.description}\n\n📎 Вложений: {o.attachments_count}"
-        )
-        kb = InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="💰 Предложить цену", callback_data=f"ebid:{o.id}")]
-        ])
-        await c.message.answer(text, reply_markup=kb)
+        await c.message.answer(order_card(o), reply_markup=bid_kb(o))
     await c.answer()
 
+# --------------------- Executor: Availability ---------------------
+
+AVAIL_HOURS = range(7, 23)  # 07:00–22:00
+
+async def show_availability(uid: int):
+    u = USERS.get(uid)
+    if u:
+        set_availability(u, u.availability)  # отбросить прошедшее
+    text = "🗓 Ваша доступность:\n" + ("\n".join(
+        f"• {start.strftime('%a %d.%m %H:%M')}–{end.strftime('%H:%M')}" for start, end in u.availability
+    ) if u and u.availability else "пока не указана")
+    rows = [[InlineKeyboardButton(text="➕ Добавить время", callback_data="eav:add")]]
+    if u and u.availability:
+        rows.append([InlineKeyboardButton(text="🕒 Заказы в моё время", callback_data="e:feedfree")])
+        rows.append([InlineKeyboardButton(text="🗑 Очистить", callback_data="eav:clear")])
+    rows.append([InlineKeyboardButton(text="В меню", callback_data="home")])
+    await bot.send_message(uid, text, reply_markup=InlineKeyboardMarkup(inline_keyboard=rows))
+
+@dp.callback_query(F.data == "e:avail")
+async def e_avail(c: CallbackQuery):
+    await show_availability(c.from_user.id)
+    await c.answer()
+
+@dp.callback_query(F.data == "eav:add")
+async def e_avail_add(c: CallbackQuery):
+    today = datetime.now()
+    rows = [[InlineKeyboardButton(text=d.strftime("%a %d.%m"), callback_data=f"eavd:{d.strftime('%Y-%m-%d')}")]
+            for d in (today + timedelta(days=i) for i in range(0, 7))]
+    rows.append([InlineKeyboardButton(text="Отмена", callback_data="e:avail")])
+    await c.message.answer("📅 Выберите день:", reply_markup=InlineKeyboardMarkup(inline_keyboard=rows))
+    await c.answer()
+
+def _hours_kb(prefix: str, hours) -> InlineKeyboardMarkup:
+    btns = [InlineKeyboardButton(text=f"{h:02d}:00", callback_data=f"{prefix}:{h}") for h in hours]
+    rows = [btns[i:i + 4] for i in range(0, len(btns), 4)]
+    rows.append([InlineKeyboardButton(text="Отмена", callback_data="e:avail")])
+    return InlineKeyboardMarkup(inline_keyboard=rows)
+
+@dp.callback_query(F.data.startswith("eavd:"))
+async def e_avail_day(c: CallbackQuery):
+    day = c.data.split(":", 1)[1]
+    now = datetime.now()
+    # Сегодня предлагаем только часы, которые ещё не прошли
+    first = now.hour if day == now.strftime("%Y-%m-%d") else AVAIL_HOURS[0]
+    hours = [h for h in AVAIL_HOURS[:-1] if h >= first]
+    if not hours:
+        await c.answer("На сегодня время уже прошло — выберите другой день", show_alert=True)
+        return
+    await c.message.answer("⏰ С какого часа свободны?", reply_markup=_hours_kb(f"eavs:{day}", hours))
+    await c.answer()
+
+@dp.callback_query(F.data.startswith("eavs:"))
+async def e_avail_start(c: CallbackQuery):
+    _, day, h = c.data.split(":")
+    await c.message.answer("⏰ До какого часа?", reply_markup=_hours_kb(f"eave:{day}:{h}", range(int(h) + 1, AVAIL_HOURS[-1] + 1)))
+    await c.answer()
+
+@dp.callback_query(F.data.startswith("eave:"))
+async def e_avail_end(c: CallbackQuery):
+    _, day, h1, h2 = c.data.split(":")
+    u = USERS.get(c.from_user.id)
+    if not u:
+        await c.answer("Сначала выберите роль: /start", show_alert=True)
+        return
+    base = datetime.strptime(day, "%Y-%m-%d")
+    end = base + timedelta(hours=int(h2))
+    if end <= datetime.now():
+        # Кнопка из старого сообщения — такой интервал set_availability всё равно отбросит
+        await c.answer("Это время уже прошло — выберите другое", show_alert=True)
+        return
+    set_availability(u, u.availability + [(base + timedelta(hours=int(h1)), end)])
+    await c.answer("Сохранено")
+    await show_availability(c.from_user.id)
+
+@dp.callback_query(F.data == "eav:clear")
+async def e_avail_clear(c: CallbackQuery):
+    u = USERS.get(c.from_user.id)
+    if u:
+        set_availability(u, [])
+    await c.answer("Очищено")
+    await show_availability(c.from_user.id)
+
 @dp.callback_query(F.data.startswith("ebid:"))
 async def e_bid(c: CallbackQuery, state: FSMContext):
     oid = int(c.data.split(":", 1)[1])
@@ -440,6 +867,8 @@ async def e_price(m: Message, state: FSMContext):
     except Exception:
         await m.answer("Пожалуйста, введите число, например 350")
         return
+    if m.from_user.id not in o.bids:
+        STATS.bids_total += 1
     o.bids[m.from_user.id] = price
     await state.clear()
     commission = round(price * COMMISSION_PCT, 2)
@@ -492,7 +921,10 @@ async def c_choose(c: CallbackQuery):
     total = round(price + commission, 2)
     o.status = "matched"
     o.chosen_executor_id = eid
+    ORDER_DEDUP.remove(o.id)
+    stats_order_matched(price)
     ACTIVE_CHATS[o.customer_id] = (eid, o.id)
+    MATCHES.setdefault(o.id, Match(order_id=o.id, customer_id=o.customer_id, executor_id=eid))
     ACTIVE_CHATS[eid] = (o.customer_id, o.id)
     await c.message.answer(
         f"✅ Исполнитель выбран. Общая сумма для клиента: *{total:.2f}*.\n"
@@ -528,7 +960,10 @@ async def cmd_reveal(m: Message):
         await bot.send_message(mt.executor_id, f"🔓 Контакты раскрыты: {mention(cu.user_id, cu.username, cu.full_name)}")
     else:
         await m.answer("Запрос принят. Раскроем контакты после согласия второй стороны или одобрения диспетчера.")
-        await notify_dispatchers(f"🔔 Запрос на раскрытие контактов по заказу #{oid}. Одобрить: /approve_reveal {oid}")
+        await notify_dispatchers(
+            f"🔔 Запрос на раскрытие контактов по заказу #{oid}. Одобрить: /approve_reveal {oid}",
+            kb=transcript_kb(oid)
+        )
 
 @dp.message(Command("approve_reveal"))
 async def cmd_approve_reveal(m: Message):
@@ -570,12 +1005,569 @@ async def cmd_end(m: Message):
     o = ORDERS.get(oid)
     if o:
         o.status = "closed"
+        ORDER_DEDUP.remove(oid)
+    mt = MATCHES.get(oid)
+    if mt:
+        transcript_close(mt)  # закрытый чат не держим в памяти
     await m.answer("Чат завершён. Заказ закрыт.")
     try:
         await bot.send_message(peer_id, "Чат завершён. Заказ закрыт.")
     except Exception:
         pass
 
+# --------------------- Broadcast (push-рассылка) ---------------------
+# Кампания хранит снимок получателей и курсор; курсор сохраняется на диск
+# каждые BROADCAST_SAVE_EVERY отправок, поэтому после рестарта рассылка
+# продолжается с места остановки (повтор — не больше BROADCAST_SAVE_EVERY сообщений).
+
+SEGMENTS = {
+    "all": "Все",
+    "customers": "Заказчики",
+    "executors": "Исполнители",
+    "open": "С открытым заказом",
+    "idle7": "Неактивны 7+ дней",
+    "idle30": "Неактивны 30+ дней",
+}
+
+def segment_user_ids(code: str) -> List[int]:
+    now = datetime.utcnow()
+    if code == "customers":
+        ids = {u.user_id for u in USERS.values() if u.role == "customer"}
+    elif code == "executors":
+        ids = {u.user_id for u in USERS.values() if u.role == "executor"}
+    elif code == "open":
+        ids = {o.customer_id for o in ORDERS.values() if o.status == "open"}
+    elif code.startswith("idle"):
+        days = int(code[4:])
+        ids = {u.user_id for u in USERS.values() if now - u.last_seen >= timedelta(days=days)}
+    else:
+        ids = set(USERS)
+    return sorted(uid for uid in ids if uid in USERS and not USERS[uid].blocked)
+
+def _campaign_targets_path(cid: int) -> str:
+    return os.path.join(BROADCAST_DIR, f"{cid}.targets")
+
+def save_campaigns():
+    # Метаданные (курсор, статистика) — маленький файл, перезаписываем атомарно
+    os.makedirs(BROADCAST_DIR, exist_ok=True)
+    meta = []
+    for cp in CAMPAIGNS.values():
+        meta.append({
+            "id": cp.id, "created_by": cp.created_by, "segment": cp.segment,
+            "from_chat_id": cp.from_chat_id, "message_id": cp.message_id,
+            "cursor": cp.cursor, "status": cp.status, "sent": cp.sent,
+            "blocked": cp.blocked, "failed": cp.failed, "created_ts": cp.created_ts.isoformat(),
+        })
+    path = os.path.join(BROADCAST_DIR, "campaigns.json")
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(meta, f)
+    os.replace(path + ".tmp", path)
+
+def load_campaigns():
+    global _campaign_seq
+    path = os.path.join(BROADCAST_DIR, "campaigns.json")
+    if not os.path.exists(path):
+        return
+    with open(path, encoding="utf-8") as f:
+        meta = json.load(f)
+    for d in meta:
+        d["created_ts"] = datetime.fromisoformat(d["created_ts"])
+        cp = Campaign(**d)
+        try:
+            with open(_campaign_targets_path(cp.id), encoding="utf-8") as f:
+                cp.targets = [int(x) for x in f.read().split()]
+        except FileNotFoundError:
+            cp.status = "cancelled"
+        CAMPAIGNS[cp.id] = cp
+        _campaign_seq = max(_campaign_seq, cp.id + 1)
+
+def create_campaign(created_by: int, segment: str, from_chat_id: int, message_id: int) -> Campaign:
+    cp = Campaign(
+        id=next_campaign_id(), created_by=created_by, segment=segment,
+        from_chat_id=from_chat_id, message_id=message_id,
+        targets=segment_user_ids(segment),
+    )
+    CAMPAIGNS[cp.id] = cp
+    # Список получателей пишем один раз, дальше меняется только курсор
+    os.makedirs(BROADCAST_DIR, exist_ok=True)
+    with open(_campaign_targets_path(cp.id), "w", encoding="utf-8") as f:
+        f.write("\n".join(str(uid) for uid in cp.targets))
+    save_campaigns()
+    return cp
+
+def start_campaign(cp: Campaign):
+    cp.status = "running"
+    task = CAMPAIGN_TASKS.get(cp.id)
+    if task and not task.done():
+        return
+    CAMPAIGN_TASKS[cp.id] = asyncio.create_task(run_campaign(cp))
+
+# Общий для всех рассылок темп: сколько бы кампаний ни шло, вместе они
+# отправляют не больше BROADCAST_RATE сообщений/сек
+_broadcast_lock = asyncio.Lock()
+_broadcast_next = 0.0
+
+async def broadcast_slot():
+    global _broadcast_next
+    async with _broadcast_lock:
+        loop = asyncio.get_running_loop()
+        wait = _broadcast_next - loop.time()
+        if wait > 0:
+            await asyncio.sleep(wait)
+        _broadcast_next = max(loop.time(), _broadcast_next) + 1.0 / BROADCAST_RATE
+
+def broadcast_backoff(seconds: float):
+    # RetryAfter от Telegram тормозит все рассылки, а не только текущую
+    global _broadcast_next
+    _broadcast_next = max(_broadcast_next, asyncio.get_running_loop().time() + seconds)
+
+async def run_campaign(cp: Campaign):
+    # Фоновая задача: интерактивные апдейты обрабатываются между отправками
+    # и не ждут конца рассылки.
+    unsaved = 0
+    while cp.status == "running" and cp.cursor < len(cp.targets):
+        uid = cp.targets[cp.cursor]
+        u = USERS.get(uid)
+        if u and u.blocked:
+            cp.blocked += 1
+        else:
+            await broadcast_slot()
+            if cp.status != "running":
+                break
+            try:
+                await bot.copy_message(chat_id=uid, from_chat_id=cp.from_chat_id, message_id=cp.message_id)
+                cp.sent += 1
+            except TelegramRetryAfter as e:
+                broadcast_backoff(e.retry_after)
+                continue
+            except TelegramForbiddenError:
+                cp.blocked += 1
+                if u:
+                    u.blocked = True
+            except Exception:
+                cp.failed += 1
+        cp.cursor += 1
+        unsaved += 1
+        if unsaved >= BROADCAST_SAVE_EVERY:
+            save_campaigns()
+            unsaved = 0
+    if cp.status == "running":
+        cp.status = "done"
+        try:
+            await bot.send_message(cp.created_by, f"📣 Рассылка #{cp.id} завершена.\n{campaign_line(cp)}")
+        except Exception:
+            pass
+    save_campaigns()
+
+def resume_campaigns():
+    for cp in CAMPAIGNS.values():
+        if cp.status == "running":
+            start_campaign(cp)
+
+CAMPAIGN_STATUS = {"running": "идёт", "paused": "пауза", "done": "завершена", "cancelled": "отменена"}
+
+def campaign_line(cp: Campaign) -> str:
+    return (
+        f"#{cp.id} • {SEGMENTS.get(cp.segment, cp.segment)} • {cp.cursor}/{len(cp.targets)} • "
+        f"доставлено {cp.sent}, заблокировали {cp.blocked}, ошибок {cp.failed} • {CAMPAIGN_STATUS.get(cp.status, cp.status)}"
+    )
+
+@dp.callback_query(F.data == "d:bc")
+async def d_bc(c: CallbackQuery):
+    if not is_dispatcher(c.from_user.id):
+        await c.answer("Нет доступа", show_alert=True)
+        return
+    rows = [[InlineKeyboardButton(text="➕ Новая рассылка", callback_data="d:bcnew")]]
+    lines = []
+    for cp in sorted(CAMPAIGNS.values(), key=lambda x: x.id, reverse=True)[:10]:
+        lines.append(campaign_line(cp))
+        if cp.status == "running":
+            rows.append([InlineKeyboardButton(text=f"⏸ Пауза #{cp.id}", callback_data=f"d:bcpause:{cp.id}"),
+                         InlineKeyboardButton(text=f"✖ Отменить #{cp.id}", callback_data=f"d:bccancel:{cp.id}")])
+        elif cp.status == "paused":
+            rows.append([InlineKeyboardButton(text=f"▶️ Продолжить #{cp.id}", callback_data=f"d:bcresume:{cp.id}"),
+                         InlineKeyboardButton(text=f"✖ Отменить #{cp.id}", callback_data=f"d:bccancel:{cp.id}")])
+    await c.message.answer("\n".join(lines) or "Рассылок пока не было.", reply_markup=InlineKeyboardMarkup(inline_keyboard=rows))
+    await c.answer()
+
+@dp.callback_query(F.data == "d:bcnew")
+async def d_bcnew(c: CallbackQuery):
+    if not is_dispatcher(c.from_user.id):
+        await c.answer("Нет доступа", show_alert=True)
+        return
+    rows = [
+        [InlineKeyboardButton(text=f"{title} ({len(segment_user_ids(code))})", callback_data=f"d:bcseg:{code}")]
+        for code, title in SEGMENTS.items()
+    ]
+    rows.append([InlineKeyboardButton(text="Отмена", callback_data="home")])
+    await c.message.answer("Кому отправить?", reply_markup=InlineKeyboardMarkup(inline_keyboard=rows))
+    await c.answer()
+
+@dp.callback_query(F.data.startswith("d:bcseg:"))
+async def d_bcseg(c: CallbackQuery, state: FSMContext):
+    if not is_dispatcher(c.from_user.id):
+        await c.answer("Нет доступа", show_alert=True)
+        return
+    code = c.data.split(":", 2)[2]
+    if code not in SEGMENTS:
+        await c.answer("Неизвестный сегмент", show_alert=True)
+        return
+    await state.set_state(Broadcast.waiting_message)
+    await state.update_data(segment=code)
+    kb = InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="Отмена", callback_data="home")]])
+    await c.message.answer("Пришлите сообщение для рассылки (текст, фото или файл) — оно будет скопировано получателям.", reply_markup=kb)
+    await c.answer()
+
+@dp.message(Broadcast.waiting_message)
+async def d_bc_message(m: Message, state: FSMContext):
+    data = await state.get_data()
+    segment = data.get("segment", "all")
+    await state.update_data(from_chat_id=m.chat.id, message_id=m.message_id)
+    rows = [[InlineKeyboardButton(text="🚀 Запустить", callback_data="d:bcgo")],
+            [InlineKeyboardButton(text="Отмена", callback_data="home")]]
+    await m.answer(
+        f"Сегмент: *{SEGMENTS[segment]}*, получателей: *{len(segment_user_ids(segment))}*. Запускаем?",
+        reply_markup=InlineKeyboardMarkup(inline_keyboard=rows)
+    )
+
+@dp.callback_query(F.data == "d:bcgo")
+async def d_bcgo(c: CallbackQuery, state: FSMContext):
+    if not is_dispatcher(c.from_user.id):
+        await c.answer("Нет доступа", show_alert=True)
+        return
+    data = await state.get_data()
+    if "message_id" not in data:
+        await c.answer("Сначала пришлите сообщение", show_alert=True)
+        return
+    await state.clear()
+    cp = create_campaign(c.from_user.id, data["segment"], data["from_chat_id"], data["message_id"])
+    start_campaign(cp)
+    await c.message.answer(f"📣 Рассылка #{cp.id} запущена: {len(cp.targets)} получателей. Прогресс — в «Рассылки».")
+    await c.answer()
+
+@dp.callback_query(F.data.regexp(r"^d:bc(pause|resume|cancel):\d+$"))
+async def d_bc_control(c: CallbackQuery):
+    if not is_dispatcher(c.from_user.id):
+        await c.answer("Нет доступа", show_alert=True)
+        return
+    _, action, cid_s = c.data.split(":")
+    cp = CAMPAIGNS.get(int(cid_s))
+    if not cp or cp.status in ("done", "cancelled"):
+        await c.answer("Рассылка уже завершена", show_alert=True)
+        return
+    if action == "bcpause":
+        cp.status = "paused"
+    elif action == "bcresume":
+        start_campaign(cp)
+    else:
+        cp.status = "cancelled"
+    save_campaigns()
+    await c.message.answer(campaign_line(cp))
+    await c.answer()
+
+# --------------------- Dispatcher: Export & Stats ---------------------
+
+def _fmt_dt(dt: Optional[datetime]) -> str:
+    return dt.strftime("%Y-%m-%d %H:%M") if dt else ""
+
+def export_orders_rows() -> Iterator[list]:
+    yield ["id", "created", "customer_id", "status", "when", "address", "lat", "lon",
+           "attachments", "bids", "chosen_executor_id", "description"]
+    # Снимок списка ссылок: между чанками обрабатываются другие апдейты
+    for o in list(ORDERS.values()):
+        lat, lon = o.latlon or ("", "")
+        yield [o.id, _fmt_dt(o.created_ts), o.customer_id, o.status, _fmt_dt(o.when_dt), o.address_text or "",
+               lat, lon, o.attachments_count, len(o.bids), o.chosen_executor_id or "", o.description]
+
+def export_bids_rows() -> Iterator[list]:
+    yield ["order_id", "executor_id", "price", "commission", "total", "chosen"]
+    for o in list(ORDERS.values()):
+        for eid, price in list(o.bids.items()):
+            commission = round(price * COMMISSION_PCT, 2)
+            yield [o.id, eid, f"{price:.2f}", f"{commission:.2f}", f"{price + commission:.2f}",
+                   int(o.chosen_executor_id == eid)]
+
+def export_calls_rows() -> Iterator[list]:
+    yield ["id", "ts_utc", "from_user_id", "from_name", "phone", "source", "status"]
+    for l in list(CALL_LOGS.values()):
+        yield [l.id, _fmt_dt(l.ts), l.from_user_id, l.from_name, l.phone, l.source, l.status]
+
+EXPORTS: Dict[str, Callable[[], Iterator[list]]] = {
+    "orders": export_orders_rows,
+    "bids": export_bids_rows,
+    "calls": export_calls_rows,
+}
+
+_CSV_FORMULA_CHARS = ("=", "+", "-", "@", "\t", "\r")
+
+def csv_safe(value):
+    # Excel выполняет ячейки, начинающиеся с =+-@, как формулы — экранируем апострофом
+    if isinstance(value, str) and value.startswith(_CSV_FORMULA_CHARS):
+        return "'" + value
+    return value
+
+class CsvStreamFile(InputFile):
+    # CSV формируется по строкам прямо во время загрузки: в памяти
+    # держится только текущий чанк, а не весь файл
+    def __init__(self, rows: Callable[[], Iterator[list]], filename: str):
+        super().__init__(filename=filename)
+        self.rows = rows
+
+    async def read(self, bot: Bot) -> AsyncGenerator[bytes, None]:
+        buf = io.StringIO()
+        writer = csv.writer(buf)
+        buf.write("\ufeff")  # BOM, чтобы Excel понял UTF-8
+        for row in self.rows():
+            writer.writerow([csv_safe(v) for v in row])
+            if buf.tell() >= self.chunk_size:
+                yield buf.getvalue().encode("utf-8")
+                buf.seek(0)
+                buf.truncate()
+                await asyncio.sleep(0)
+        if buf.tell():
+            yield buf.getvalue().encode("utf-8")
+
+@dp.message(Command("export"))
+async def cmd_export(m: Message):
+    if not is_dispatcher(m.from_user.id):
+        await m.answer("Команда только для диспетчеров.")
+        return
+    parts = (m.text or "").split()
+    kinds = parts[1:] or list(EXPORTS)
+    if any(k not in EXPORTS for k in kinds):
+        await m.answer("Используйте: /export [orders|bids|calls]")
+        return
+    stamp = datetime.utcnow().strftime("%Y%m%d_%H%M")
+    for k in kinds:
+        await bot.send_document(m.chat.id, CsvStreamFile(EXPORTS[k], f"{k}_{stamp}.csv"))
+
+def stats_text() -> str:
+    today = datetime.utcnow().date()
+    days = [(today - timedelta(days=i)).strftime("%Y-%m-%d") for i in range(7)]
+    per_day = ", ".join(f"{d[8:10]}.{d[5:7]}: {STATS.orders_per_day.get(d, 0)}" for d in days)
+    rate = STATS.orders_matched / STATS.orders_total * 100 if STATS.orders_total else 0.0
+    return (
+        f"📊 Заказов: *{STATS.orders_total}*, с исполнителем: *{STATS.orders_matched}* ({rate:.0f}%)\n"
+        f"Предложений: {STATS.bids_total}\n"
+        f"Оборот: *{STATS.gross_total:.2f}*, комиссия ({COMMISSION_PCT * 100:g}%): *{STATS.commission_total:.2f}*\n"
+        f"Заказы по дням (UTC): {per_day}"
+    )
+
+@dp.message(Command("stats"))
+async def cmd_stats(m: Message):
+    if not is_dispatcher(m.from_user.id):
+        await m.answer("Команда только для диспетчеров.")
+        return
+    await m.answer(stats_text())
+
+@dp.callback_query(F.data == "d:stats")
+async def d_stats(c: CallbackQuery):
+    if not is_dispatcher(c.from_user.id):
+        await c.answer("Нет доступа", show_alert=True)
+        return
+    await c.message.answer(stats_text())
+    await c.answer()
+
+# --------------------- Dispatcher: Transcripts ---------------------
+# В памяти — не больше TRANSCRIPT_RING сообщений по TRANSCRIPT_MAX_TEXT символов
+# на чат; при переполнении старшая половина дописывается в файл. В поисковом
+# индексе — не больше TRANSCRIPT_MAX_TOKENS слов на активный чат; после /end
+# все слова чата (перечитываем его файл) пишутся в индекс слово -> файлы
+# на диске: TRANSCRIPT_DIR/index/<crc32(слово) % 256>.jsonl.
+
+TRANSCRIPT_PAGE = 10
+TSEARCH_LIMIT = 5  # чатов в ответе /tsearch
+TRANSCRIPT_INDEX_BUCKETS = 256  # файлов в индексе закрытых чатов
+_TOKEN_RE = re.compile(r"\w{3,}")
+
+def _tokens(text: str) -> set:
+    return set(_TOKEN_RE.findall((text or "").lower().replace("ё", "е")))
+
+def _transcript_path(mt: Match) -> str:
+    return os.path.join(TRANSCRIPT_DIR, f"{mt.order_id}_{mt.key}.jsonl")
+
+def transcript_spill(mt: Match, n: int):
+    if n <= 0:
+        return
+    os.makedirs(TRANSCRIPT_DIR, exist_ok=True)
+    with open(_transcript_path(mt), "a", encoding="utf-8") as f:
+        for _ in range(n):
+            f.write(json.dumps(mt.transcript.popleft(), ensure_ascii=False) + "\n")
+    mt.spilled += n
+
+def transcript_add(oid: int, uid: int, kind: str, text: str):
+    mt = MATCHES.get(oid)
+    if not mt:
+        o = ORDERS.get(oid)
+        if not o or not o.chosen_executor_id:
+            return
+        mt = MATCHES[oid] = Match(order_id=oid, customer_id=o.customer_id, executor_id=o.chosen_executor_id)
+    text = (text or "")[:TRANSCRIPT_MAX_TEXT]
+    if len(mt.transcript) >= TRANSCRIPT_RING:
+        transcript_spill(mt, max(TRANSCRIPT_RING // 2, 1))
+    mt.transcript.append((int(time.time()), uid, kind, text))
+    for t in _tokens(text) - mt.tokens:
+        if len(mt.tokens) >= TRANSCRIPT_MAX_TOKENS:
+            mt.tokens_overflow = True
+            break
+        mt.tokens.add(t)
+        TRANSCRIPT_INDEX.setdefault(t, set()).add(oid)
+
+def transcript_close(mt: Match):
+    # Сбрасываем остаток переписки и слова чата на диск, память освобождаем
+    mt.active = False
+    transcript_spill(mt, len(mt.transcript))
+    for t in mt.tokens:
+        oids = TRANSCRIPT_INDEX.get(t)
+        if oids is not None:
+            oids.discard(mt.order_id)
+            if not oids:
+                del TRANSCRIPT_INDEX[t]
+    mt.tokens = set()
+    mt.tokens_overflow = False
+    if not mt.spilled:
+        return
+    # Все слова чата, а не только попавшие в память: перечитываем файл целиком
+    words = set()
+    with open(_transcript_path(mt), encoding="utf-8") as f:
+        for line in f:
+            words |= _tokens(json.loads(line)[3])
+    posting = {"o": mt.order_id, "c": mt.customer_id, "f": os.path.basename(_transcript_path(mt)), "ts": int(time.time())}
+    buckets: Dict[int, List[str]] = {}
+    for w in words:
+        buckets.setdefault(_index_bucket(w), []).append(json.dumps({"w": w, **posting}, ensure_ascii=False))
+    os.makedirs(os.path.join(TRANSCRIPT_DIR, "index"), exist_ok=True)
+    for b, lines in buckets.items():
+        with open(_index_bucket_path(b), "a", encoding="utf-8") as f:
+            f.write("\n".join(lines) + "\n")
+
+def _index_bucket(word: str) -> int:
+    return zlib.crc32(word.encode("utf-8")) % TRANSCRIPT_INDEX_BUCKETS
+
+def _index_bucket_path(b: int) -> str:
+    return os.path.join(TRANSCRIPT_DIR, "index", f"{b:03d}.jsonl")
+
+def closed_postings(word: str) -> Dict[str, dict]:
+    # Файлы закрытых чатов со словом: читаем только корзину этого слова
+    path = _index_bucket_path(_index_bucket(word))
+    out = {}
+    if os.path.exists(path):
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                p = json.loads(line)
+                if p["w"] == word:
+                    out[p["f"]] = p
+    return out
+
+def transcript_total(mt: Match) -> int:
+    return mt.spilled + len(mt.transcript)
+
+def transcript_entries(mt: Match, start: int, stop: int) -> list:
+    # Сквозная нумерация [start, stop): сначала сброшенное на диск, затем память
+    out = []
+    if start < mt.spilled:
+        with open(_transcript_path(mt), encoding="utf-8") as f:
+            out = [tuple(json.loads(line)) for line in islice(f, start, min(stop, mt.spilled))]
+    out.extend(islice(mt.transcript, max(start - mt.spilled, 0), max(stop - mt.spilled, 0)))
+    return out
+
+def transcript_line(customer_id: int, entry) -> str:
+    ts, uid, kind, text = entry
+    who = "Заказчик" if uid == customer_id else "Исполнитель"
+    body = text if kind == "text" else f"[{kind}] {text}".rstrip()
+    return f"{datetime.utcfromtimestamp(ts).strftime('%d.%m %H:%M')} {who}: {body}"
+
+def transcript_kb(oid: int) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text=f"📜 Переписка #{oid}", callback_data=f"d:tr:{oid}:0")]])
+
+async def send_transcript_page(chat_id: int, oid: int, page: int):
+    mt = MATCHES.get(oid)
+    total = transcript_total(mt) if mt else 0
+    if not total:
+        await bot.send_message(chat_id, f"Переписка по заказу #{oid} пуста.")
+        return
+    # Страница 0 — самые свежие сообщения
+    page = min(max(page, 0), (total - 1) // TRANSCRIPT_PAGE)
+    stop = max(total - page * TRANSCRIPT_PAGE, 0)
+    start = max(stop - TRANSCRIPT_PAGE, 0)
+    lines = [f"📜 Заказ #{oid}, сообщения {start + 1}–{stop} из {total}:"]
+    lines += [transcript_line(mt.customer_id, e) for e in transcript_entries(mt, start, stop)]
+    nav = []
+    if start > 0:
+        nav.append(InlineKeyboardButton(text="⬅️ Раньше", callback_data=f"d:tr:{oid}:{page + 1}"))
+    if page > 0:
+        nav.append(InlineKeyboardButton(text="Позже ➡️", callback_data=f"d:tr:{oid}:{page - 1}"))
+    # Без Markdown: в переписке могут быть * и _
+    await bot.send_message(chat_id, "\n".join(lines), parse_mode=None,
+                           reply_markup=InlineKeyboardMarkup(inline_keyboard=[nav]) if nav else None)
+
+@dp.callback_query(F.data.startswith("d:tr:"))
+async def d_transcript(c: CallbackQuery):
+    if not is_dispatcher(c.from_user.id):
+        await c.answer("Нет доступа", show_alert=True)
+        return
+    try:
+        _, _, oid_s, page_s = c.data.split(":")
+        oid, page = int(oid_s), int(page_s)
+    except Exception:
+        await c.answer("Неверный запрос", show_alert=True)
+        return
+    await send_transcript_page(c.from_user.id, oid, page)
+    await c.answer()
+
+@dp.message(Command("transcript"))
+async def cmd_transcript(m: Message):
+    if not is_dispatcher(m.from_user.id):
+        await m.answer("Команда только для диспетчеров.")
+        return
+    parts = (m.text or "").split()
+    try:
+        oid = int(parts[1])
+        page = int(parts[2]) if len(parts) > 2 else 0
+    except Exception:
+        await m.answer("Используйте: /transcript <order_id> [страница]")
+        return
+    await send_transcript_page(m.chat.id, oid, page)
+
+@dp.message(Command("tsearch"))
+async def cmd_tsearch(m: Message):
+    if not is_dispatcher(m.from_user.id):
+        await m.answer("Команда только для диспетчеров.")
+        return
+    terms = _tokens((m.text or "").partition(" ")[2])
+    if not terms:
+        await m.answer("Используйте: /tsearch <слова> (от 3 букв)")
+        return
+    out = []
+    found = 0
+
+    def add_hits(oid: int, customer_id: int, entries):
+        nonlocal found
+        hits = [e for e in entries if terms <= _tokens(e[3])]
+        if hits:
+            found += 1
+            out.append(f"📜 Заказ #{oid} (совпадений: {len(hits)}):")
+            out.extend(transcript_line(customer_id, e) for e in hits[-3:])
+
+    # Активные чаты — по индексу в памяти; чаты, чьи слова не влезли в индекс, — перебором
+    oids = set.intersection(*(TRANSCRIPT_INDEX.get(t, set()) for t in terms))
+    oids |= {mt.order_id for mt in MATCHES.values() if mt.active and mt.tokens_overflow}
+    for oid in sorted(oids, reverse=True):
+        mt = MATCHES.get(oid)
+        if mt and found < TSEARCH_LIMIT:
+            add_hits(oid, mt.customer_id, transcript_entries(mt, 0, transcript_total(mt)))
+    # Закрытые — по индексу слово -> файлы на диске, свежие первыми
+    if found < TSEARCH_LIMIT:
+        postings = [closed_postings(t) for t in terms]
+        files = set.intersection(*(set(p) for p in postings))
+        for name in sorted(files, key=lambda fn: postings[0][fn]["ts"], reverse=True):
+            p = postings[0][name]
+            with open(os.path.join(TRANSCRIPT_DIR, name), encoding="utf-8") as tf:
+                add_hits(p["o"], p["c"], (tuple(json.loads(x)) for x in tf))
+            if found >= TSEARCH_LIMIT:
+                break
+    await bot.send_message(m.chat.id, "\n".join(out) or "Ничего не нашлось.", parse_mode=None)
+
 # --------------------- PHONE HANDLERS ---------------------
 
 @dp.callback_query(F.data.startswith("call:"))
@@ -618,9 +1610,9 @@ async def receive_phone_text(m: Message, state: FSMContext):
 # Перехват номера, если просто написали текстом вне шагов/чатов
 @dp.message(F.text)
 async def fallback_catch_phone(m: Message, state: FSMContext):
-    if await state.get_state() is not None:
-        return
     if ACTIVE_CHATS.get(m.from_user.id):
+        raise SkipHandler()  # сообщение в анонимный чат — дальше в relay_text
+    if await state.get_state() is not None:
         return
     digits = only_digits_phone(m.text or "")
     if len(digits) >= 7:
@@ -645,22 +1637,26 @@ async def relay_non_text(m: Message):
     link = ACTIVE_CHATS.get(m.from_user.id)
     if not link:
         return
-    peer_id, _ = link
+    peer_id, oid = link
     try:
         await bot.copy_message(chat_id=peer_id, from_chat_id=m.chat.id, message_id=m.message_id)
     except Exception:
         await m.answer("Не удалось доставить сообщение")
+        return
+    transcript_add(oid, m.from_user.id, m.content_type, m.caption or "")
 
 @dp.message(F.text)
 async def relay_text(m: Message):
     link = ACTIVE_CHATS.get(m.from_user.id)
     if not link:
         return
-    peer_id, _ = link
+    peer_id, oid = link
     try:
         await bot.copy_message(chat_id=peer_id, from_chat_id=m.chat.id, message_id=m.message_id)
     except Exception:
         await m.answer("Не удалось доставить сообщение")
+        return
+    transcript_add(oid, m.from_user.id, "text", m.text)
 
 # --------------------- Help ---------------------
 
@@ -693,6 +1689,7 @@ async def d_chats(c: CallbackQuery):
         await c.answer("Нет доступа", show_alert=True)
         return
     act = []
+    rows = []
     seen_pairs = set()
     for uid, (peer, oid) in list(ACTIVE_CHATS.items()):
         pair = tuple(sorted((uid, peer)))
@@ -705,7 +1702,9 @@ async def d_chats(c: CallbackQuery):
         cu = USERS.get(o.customer_id)
         eu = USERS.get(o.chosen_executor_id or peer)
         act.append(f"#{oid}: {mention(cu.user_id, cu.username, cu.full_name)} ↔ {mention(eu.user_id, eu.username, eu.full_name)}")
-    await c.message.answer("\n".join(act) or "Активных чатов нет")
+        rows.append([InlineKeyboardButton(text=f"📜 Переписка #{oid}", callback_data=f"d:tr:{oid}:0")])
+    await c.message.answer("\n".join(act) or "Активных чатов нет",
+                           reply_markup=InlineKeyboardMarkup(inline_keyboard=rows) if rows else None)
     await c.answer()
 
 @dp.callback_query(F.data == "d:logs")
@@ -764,7 +1763,7 @@ async def d_help(c: CallbackQuery):
     if not is_dispatcher(c.from_user.id):
         await c.answer("Нет доступа", show_alert=True)
         return
-    await c.message.answer("Команды: /approve_reveal <order_id>, /end — завершить чат. Чтобы получать заявки на звонок — укажите ADMIN_IDS.")
+    await c.message.answer("Команды: /approve_reveal <order_id>, /end — завершить чат. Рассылки — кнопка «Рассылки». /stats — статистика, /export [orders|bids|calls] — выгрузка CSV. /transcript <order_id> — переписка, /tsearch <слова> — поиск по перепискам. Чтобы получать заявки на звонок — укажите ADMIN_IDS.")
     await c.answer()
 
 # --------------------- Entry ---------------------
@@ -773,6 +1772,9 @@ async def main():
     print("Bot is running (Inline-first)…")
     # Сброс webhook, чтобы не было конфликта с прошлым хостингом
     await bot.delete_webhook(drop_pending_updates=True)
+    # Незавершённые рассылки продолжаются с сохранённого курсора
+    load_campaigns()
+    resume_campaigns()
     await dp.start_polling(bot)
 
 if __name__ == "__main__":
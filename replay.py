@@ -0,0 +1,127 @@
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import tempfile
+from collections import Counter
+from datetime import datetime
+from typing import Any, AsyncGenerator, Dict, Optional
+
+# ===================== Replay записанных апдейтов =====================
+# Прогоняет JSONL из RECORD_UPDATES через dp.feed_update с заглушкой вместо
+# Telegram API и печатает итоговое состояние и пропускную способность.
+#   python replay.py updates.jsonl [--speed original|max] [--admins 1,2]
+#                    [--expect orders=10,matches=2,call_logs=3]
+# Код выхода 1, если состояние не совпало с --expect.
+# ====================================================================
+
+def parse_args():
+    ap = argparse.ArgumentParser(description="Replay recorded Telegram updates against a stubbed Bot")
+    ap.add_argument("path", help="JSONL, записанный с RECORD_UPDATES")
+    ap.add_argument("--speed", choices=("original", "max"), default="max")
+    ap.add_argument("--admins", default="", help="ADMIN_IDS для прогона (id из записи)")
+    ap.add_argument("--expect", default="", help="orders=N,matches=N,call_logs=N")
+    return ap.parse_args()
+
+args = parse_args()
+# Окружение до импорта main: фиктивный токен, без записи, рассылки и переписки во временные папки
+os.environ["BOT_TOKEN"] = "42:replay"
+os.environ["ADMIN_IDS"] = args.admins
+os.environ["BROADCAST_DIR"] = tempfile.mkdtemp(prefix="replay_bc_")
+os.environ["TRANSCRIPT_DIR"] = tempfile.mkdtemp(prefix="replay_tr_")
+os.environ["RECORD_UPDATES"] = ""  # пустое, а не удалённое: иначе load_dotenv вернёт значение из .env
+
+from aiogram.client.session.base import BaseSession
+from aiogram.types import Update, Message, MessageId, Chat, InputFile
+
+import main
+
+class StubSession(BaseSession):
+    # Вместо HTTP-запросов считает вызовы API и возвращает правдоподобные ответы
+    def __init__(self):
+        super().__init__()
+        self.calls: Counter = Counter()
+        self._msg_id = 0
+
+    async def make_request(self, bot, method, timeout: Optional[int] = None) -> Any:
+        self.calls[type(method).__name__] += 1
+        for name in type(method).model_fields:
+            value = getattr(method, name)
+            if isinstance(value, InputFile):
+                async for _ in value.read(bot):  # выгрузку тоже прогоняем целиком
+                    pass
+        returning = method.__returning__
+        if returning is MessageId:
+            self._msg_id += 1
+            return MessageId(message_id=self._msg_id)
+        if returning is Message:
+            self._msg_id += 1
+            chat_id = getattr(method, "chat_id", 0)
+            return Message(message_id=self._msg_id, date=datetime.now(),
+                           chat=Chat(id=chat_id if isinstance(chat_id, int) else 0, type="private"))
+        return True
+
+    async def close(self):
+        pass
+
+    async def stream_content(self, url: str, headers: Optional[Dict[str, Any]] = None, timeout: int = 30,
+                             chunk_size: int = 65536, raise_for_status: bool = True) -> AsyncGenerator[bytes, None]:
+        yield b""
+
+def load_records(path: str):
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            rec = json.loads(line)
+            # Поддерживаем и голые Update без обёртки {"ts", "update"}
+            if "update" in rec:
+                yield rec.get("ts"), rec["update"]
+            else:
+                yield None, rec
+
+async def replay():
+    session = StubSession()
+    main.bot.session = session
+    records = list(load_records(args.path))
+
+    t0 = time.perf_counter()
+    first_ts = None
+    errors = 0
+    for ts, raw in records:
+        if args.speed == "original" and ts is not None:
+            if first_ts is None:
+                first_ts = ts
+            lag = (ts - first_ts) - (time.perf_counter() - t0)
+            if lag > 0:
+                await asyncio.sleep(lag)
+        update = Update.model_validate(raw, context={"bot": main.bot})
+        try:
+            await main.dp.feed_update(main.bot, update)
+        except Exception as e:
+            errors += 1
+            print(f"update {update.update_id}: {type(e).__name__}: {e}", file=sys.stderr)
+    elapsed = time.perf_counter() - t0
+
+    for task in main.CAMPAIGN_TASKS.values():
+        task.cancel()
+
+    state = {"orders": len(main.ORDERS), "matches": len(main.MATCHES), "call_logs": len(main.CALL_LOGS)}
+    n = len(records)
+    print(f"updates: {n}, errors: {errors}, time: {elapsed:.3f}s, throughput: {n / elapsed if elapsed else 0:.0f} upd/s")
+    print(f"api calls: {sum(session.calls.values())} " + json.dumps(dict(session.calls.most_common()), ensure_ascii=False))
+    print("state: " + ", ".join(f"{k}={v}" for k, v in state.items()))
+
+    ok = True
+    for item in filter(None, args.expect.split(",")):
+        k, v = item.split("=", 1)
+        if state.get(k) != int(v):
+            print(f"expected {k}={v}, got {state.get(k)}", file=sys.stderr)
+            ok = False
+    return ok and not errors
+
+if __name__ == "__main__":
+    sys.exit(0 if asyncio.run(replay()) else 1)